@@ -7,15 +7,19 @@ app = Flask(__name__)
 bundles = {
     'main_js': Bundle(
         'main.js',
-        output='gen/main.js',
+        output='gen/main.%(version)s.js',
         filters=Slimit(mangle=True),
     ),
     'main_css': Bundle(
         'main.css',
-        output='gen/main.css',
+        output='gen/main.%(version)s.css',
         filters=CSSUtils(),
     ),
 }
 
 env = Environment(app)
+# content-hashed filenames so they can be cached forever, see my_assets.py
+env.versions = 'hash'
+env.manifest = 'json:gen/manifest.json'
+env.url_expire = False
 env.register(bundles)
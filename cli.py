@@ -1,6 +1,8 @@
 import argparse
+import json
 import os
 import sys
+import time
 import my_index
 
 
@@ -9,22 +11,122 @@ def test(ix):
     results = ix.searcher().search(Every('session'), limit=None)
     for result in results:
         pass
+    test_top_n(ix)
+
+
+def test_top_n(ix):
+    # a limited search has to find the same top N as an unlimited one, book filters and all
+    from whoosh.scoring import BM25F
+    from my_whoosh import DescDateBM25F, AscDateBM25F
+
+    queries = ['book:ss inner', 'book:(ss OR tma) exercise', "book:tes* exact:'inner self'",
+               'NOT book:ss inner', "NOT book:(ss OR tma) exact:'inner self'", 'NOT book:wth exercise', 'inner ANDNOT book:ss']
+    for query_str in queries:
+        q = my_index.parse_query('stemmed', query_str)
+        for weighting in (BM25F, DescDateBM25F, AscDateBM25F):
+            with ix.searcher(weighting=weighting) as searcher:
+                top = [(hit.docnum, hit.score) for hit in searcher.search(q, limit=10)]
+                expected = [(hit.docnum, hit.score) for hit in searcher.search(q, limit=None)][:10]
+                assert top == expected, (query_str, weighting.__name__, top, expected)
+
+
+def stats(ix, path, queries_path):
+    import my_stats
+    from my_body import get_body_stats
+    from my_queries import load_queries
+
+    report = {
+        'index': my_stats.get_index_stats(ix),
+        'body': get_body_stats('index', ix),
+        'memory': my_stats.get_memory_stats(load_queries(queries_path)),
+    }
+    if path == '-':
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+def rebuild(index_dir, shards, compress, verbose, profile_path):
+    my_index.timer.verbose = verbose
+    if profile_path:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
+    if shards is not None:
+        my_index.new_sharded_index(index_dir, shards, compress)
+    else:
+        my_index.new_index(index_dir, compress)
+
+    if profile_path:
+        profile.disable()
+        profile.dump_stats(profile_path)
+    if verbose:
+        my_index.timer.print_report()
+
+
+def snapshots(ix, queries_path, top):
+    import my_flask
+    import my_snapshots
+    from my_queries import load_queries
+
+    urls = my_snapshots.get_snapshot_urls(load_queries(queries_path), top)
+    start = time.time()
+    num_pages = my_snapshots.write_snapshots((my_index.get_build_id(ix), my_flask.app_version), urls)
+    print("{} pages from {} urls in {:.1f} s".format(num_pages, len(urls), time.time() - start))
+
+
+def batch(index_dir, queries_path, output_path, paragraphs, processes):
+    import my_batch
+
+    queries = my_batch.load_batch_queries(queries_path)
+    if output_path == '-':
+        report = my_batch.run_batch(index_dir, queries, sys.stdout, paragraphs, processes)
+    else:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            report = my_batch.run_batch(index_dir, queries, f, paragraphs, processes)
+    # stdout may be the results themselves
+    print(json.dumps(report), file=sys.stderr)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--interactive", help="load search index interactively", action='store_true')
     parser.add_argument("-r", "--rebuild", help="rebuild index", nargs='?', const="index")
+    parser.add_argument("--shards", help="with --rebuild, one sub-index per book or per this many groups of books", type=int, nargs='?', const=0)
+    parser.add_argument("-z", "--compress", help="with --rebuild, store session bodies once, compressed with a dictionary trained on the corpus", action='store_true')
+    parser.add_argument("-v", "--verbose", help="with --rebuild, report per book throughput and per stage timings", action='store_true')
+    parser.add_argument("--profile", help="with --rebuild, dump cProfile stats of this process here")
     parser.add_argument("-t", "--test", help="test", action='store_true')
+    parser.add_argument("-a", "--assets", help="build hashed, precompressed static assets", action='store_true')
+    parser.add_argument("-s", "--stats", help="report index sizes and per-stage search memory as JSON", nargs='?', const="-")
+    parser.add_argument("-S", "--snapshots", help="pre-render the most frequent queries for the current index, run after each rebuild", action='store_true')
+    parser.add_argument("--top", help="how many of the most frequent queries --snapshots renders", type=int, default=1000)
+    parser.add_argument("-b", "--batch", help="run each line of this file as a query, writing json lines of hits per book and session")
+    parser.add_argument("-o", "--output", help="where --batch writes its json lines", default="-")
+    parser.add_argument("-p", "--paragraphs", help="with --batch, also write each hit's matching paragraphs", action='store_true')
+    parser.add_argument("-j", "--processes", help="with --batch, how many processes run queries, by default one per cpu", type=int)
+    parser.add_argument("-q", "--queries", help="json lines with a 'query' key for --stats and --snapshots, template examples are always included")
     args = parser.parse_args()
 
     if args.rebuild:
-        my_index.new_index(args.rebuild)
+        rebuild(args.rebuild, args.shards, args.compress, args.verbose, args.profile)
+    elif args.assets:
+        import my_assets
+        my_assets.build_assets()
+    elif args.batch:
+        # the index beside this script, while the queries and output stay relative to where it was run
+        batch(os.path.join(sys.path[0], 'index'), args.batch, args.output, args.paragraphs, args.processes)
     else:
         os.chdir(sys.path[0])
         ix = my_index.get_idx('index')
         if args.test:
             test(ix)
+        if args.stats:
+            stats(ix, args.stats, args.queries)
+        if args.snapshots:
+            snapshots(ix, args.queries, args.top)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+from my_queries import load_queries, get_url
+
+
+def start_gunicorn(bind, workers, threads, worker_class):
+    cmd = [sys.executable, '-m', 'gunicorn', '--bind', bind, '--workers', str(workers), '--threads', str(threads),
+           '--worker-class', worker_class, 'my_flask:app']
+    master = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    host, port = bind.split(':')
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, int(port), timeout=5)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return master
+        except OSError:
+            time.sleep(0.5)
+    master.terminate()
+    raise RuntimeError("gunicorn didn't come up on {}".format(bind))
+
+
+def get_worker_rss(master_pid):
+    # in kB, linux only
+    result = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        if int(status['PPid']) == master_pid and 'VmRSS' in status:
+            result[int(pid)] = int(status['VmRSS'].split()[0])
+    return result
+
+
+def run_client(args):
+    host, port, urls, duration, seed = args
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    latencies = []
+    errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        url = rng.choice(urls)
+        start = time.perf_counter()
+        try:
+            conn.request('GET', url)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=60)
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+def measure(bind, urls, concurrency, duration, seed):
+    host, port = bind.split(':')
+    with multiprocessing.Pool(concurrency) as pool:
+        results = pool.map(run_client, [(host, int(port), urls, duration, seed + i) for i in range(concurrency)])
+    latencies = sorted(latency for client_latencies, _ in results for latency in client_latencies)
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'throughput': len(latencies) / duration,
+        'latency_ms': {'p{}'.format(p): round(percentile(latencies, p) * 1000, 2) if latencies else None for p in (50, 90, 99)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load test the app under a local gunicorn")
+    parser.add_argument("--bind", default="127.0.0.1:8765")
+    parser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("-k", "--worker-class", default="sync")
+    parser.add_argument("-c", "--concurrency", default="1,2,4,8,16", help="comma separated client process counts")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="seconds per concurrency level")
+    parser.add_argument("-q", "--queries", help="json lines with a 'query' key, template examples are always included")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    urls = [get_url(q) for q in queries]
+    print("{} queries".format(len(queries)))
+
+    master = start_gunicorn(args.bind, args.workers, args.threads, args.worker_class)
+    try:
+        levels = []
+        for concurrency in map(int, args.concurrency.split(',')):
+            level = measure(args.bind, urls, concurrency, args.duration, args.seed)
+            level['worker_rss_kb'] = get_worker_rss(master.pid)
+            levels.append(level)
+            print("c={concurrency}\t{throughput:.1f} req/s\tp50 {latency_ms[p50]} ms\tp90 {latency_ms[p90]} ms\tp99 {latency_ms[p99]} ms\t"
+                  "{errors} errors\tRSS {rss} MB".format(rss=round(sum(level['worker_rss_kb'].values()) / 1024), **level))
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+
+    if args.json:
+        report = {'workers': args.workers, 'threads': args.threads, 'worker_class': args.worker_class, 'levels': levels}
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    os.chdir(sys.path[0])
+    main()
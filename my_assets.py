@@ -0,0 +1,47 @@
+import gzip
+import os
+
+from flask import request, send_from_directory
+
+from __init__ import app, bundles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GEN_DIR = os.path.join(app.static_folder, 'gen')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def build_assets():
+    with app.app_context():
+        for name, bundle in bundles.items():
+            bundle.build()
+            path = bundle.resolve_output()
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9))
+            if brotli:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data))
+            print("{}\t{}".format(name, os.path.relpath(path, app.static_folder)))
+
+
+# more specific than flask's own /static/ route, so this one wins
+@app.route('/static/gen/<path:filename>')
+def generated_asset(filename):
+    mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript' if filename.endswith('.js') else None
+    for encoding, ext in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.isfile(os.path.join(GEN_DIR, filename + ext)):
+            response = send_from_directory(GEN_DIR, filename + ext, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(GEN_DIR, filename, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
@@ -0,0 +1,111 @@
+import json
+import multiprocessing
+import re
+import time
+from collections import Counter
+
+from whoosh import highlight
+
+import my_index
+from my_index import parse_query, DEFAULT_FIELD, HIGHLIGHT_FIELDS
+from my_body import get_body
+from my_headings import get_heading
+from my_whoosh import ParagraphFragmenter, PinpointHighlighter
+
+# every matching paragraph, in the order they appear
+PARAGRAPH_LIMIT = 10000
+QUERIES_PER_TASK = 8
+
+
+class ParagraphFormatter(highlight.Formatter):
+    # each matching paragraph as its number and plain text rather than html
+    def format(self, fragments, replace=False):
+        return [self.format_fragment(fragment, replace) for fragment in fragments]
+
+    def format_fragment(self, fragment, replace=False):
+        return {
+            'p': len(re.findall(r'\n{2,}', fragment.text[:fragment.endchar])),
+            'text': fragment.text[fragment.startchar:fragment.endchar].strip(),
+        }
+
+
+def load_batch_queries(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# per pool worker
+_index_dir = None
+_ix = None
+_paragraphs = False
+
+
+def init_worker(index_dir, paragraphs):
+    global _index_dir, _ix, _paragraphs
+    _index_dir = index_dir
+    _ix = my_index.get_idx(index_dir)
+    _paragraphs = paragraphs
+
+
+def run_query(query_str):
+    start = time.perf_counter()
+    try:
+        q = parse_query(DEFAULT_FIELD, query_str)
+    except Exception as e:
+        return {'query': query_str, 'error': str(e)}
+
+    # queries on none of these are listings without excerpts
+    highlight_field = next((field for field in HIGHLIGHT_FIELDS if field + ':' in str(q)), None)
+    books = Counter()
+    sessions = Counter()
+    hits = []
+    with _ix.searcher() as searcher:
+        results = searcher.search(q, limit=None)
+        results.highlighter = PinpointHighlighter(fragmenter=ParagraphFragmenter(), formatter=ParagraphFormatter(), order=highlight.FIRST)
+        for hit in results:
+            heading = get_heading(hit)
+            session = '{} {}'.format(heading.book.book_abbr, heading.session or heading.short)
+            books[heading.book.book_abbr] += 1
+            sessions[session] += 1
+            if _paragraphs and highlight_field:
+                paragraphs = hit.highlights(highlight_field, text=get_body(_index_dir, hit), top=PARAGRAPH_LIMIT)
+                hits.append({'session': session, 'score': hit.score, 'paragraphs': paragraphs})
+
+    result = {
+        'query': query_str,
+        'parsed': str(q),
+        'total': len(results),
+        'books': dict(books),
+        'sessions': dict(sessions),
+    }
+    if _paragraphs:
+        result['hits'] = hits
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def run_batch(index_dir, queries, out, paragraphs=False, processes=None):
+    # one json line per query in the order given, written as each one finishes
+    start = time.time()
+    seconds = []
+    num_hits = num_errors = 0
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(index_dir, paragraphs)) as pool:
+        for result in pool.imap(run_query, queries, QUERIES_PER_TASK):
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+            if 'error' in result:
+                num_errors += 1
+                continue
+            seconds.append(result['seconds'])
+            num_hits += result['total']
+
+    elapsed = time.time() - start
+    seconds.sort()
+    return {
+        'queries': len(queries),
+        'errors': num_errors,
+        'hits': num_hits,
+        'seconds': elapsed,
+        'queries_per_s': len(queries) / elapsed,
+        'query_ms_p50': seconds[len(seconds) // 2] * 1000 if seconds else None,
+        'query_ms_p95': seconds[int(len(seconds) * 0.95)] * 1000 if seconds else None,
+    }
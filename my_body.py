@@ -0,0 +1,113 @@
+import os
+import re
+import time
+import zlib
+from collections import Counter
+from functools import lru_cache
+
+from my_filters import get_reader_id
+
+ZDICT_FILENAME = 'body.zdict'
+# zlib's window, anything further back is never referenced
+ZDICT_SIZE = 32 * 1024
+# enough for a results page plus its similar sessions
+BODY_CACHE_SIZE = 256
+ZDICT_SAMPLE_CHARS = 4 * 2 ** 20
+ZDICT_MAX_WORDS = 4
+word_re = re.compile(r'\w+\W+', re.UNICODE)
+
+
+def train_zdict(texts, size=ZDICT_SIZE):
+    # zlib has no trainer, so the dictionary is the corpus' most valuable runs of words
+    # most valuable last, where they're nearest and cheapest to reference
+    texts = list(texts)
+    step = max(1, sum(map(len, texts)) // ZDICT_SAMPLE_CHARS)
+    counts = Counter()
+    for text in texts[::step]:
+        words = word_re.findall(text)
+        for n in range(1, ZDICT_MAX_WORDS + 1):
+            counts.update(''.join(words[i:i + n]) for i in range(len(words) - n + 1))
+
+    runs = []
+    length = 0
+    # a run seen once is never worth its space, and short ones are as cheap as literals
+    for run, count in sorted(counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        if count < 2 or len(run) < 4:
+            continue
+        run = run.encode('utf-8')
+        if length + len(run) > size:
+            break
+        runs.append(run)
+        length += len(run)
+    return b''.join(reversed(runs))
+
+
+class BodyCodec:
+    def __init__(self, zdict):
+        self.zdict = zdict
+        # keyed by the compressed bytes themselves, so it's never stale
+        self.decompress = lru_cache(BODY_CACHE_SIZE)(self._decompress)
+
+    def compress(self, text):
+        c = zlib.compressobj(level=9, zdict=self.zdict)
+        return c.compress(text.encode('utf-8')) + c.flush()
+
+    def _decompress(self, data):
+        d = zlib.decompressobj(zdict=self.zdict)
+        return (d.decompress(data) + d.flush()).decode('utf-8')
+
+
+def write_zdict(index_dir, zdict):
+    with open(os.path.join(index_dir, ZDICT_FILENAME), 'wb') as f:
+        f.write(zdict)
+
+
+_codecs = {}
+
+
+def get_codec(index_dir, reader_id):
+    # None if the index stores its bodies uncompressed, the file is only read again for a reader on other segments
+    # not per generation, a rebuild retrains the dictionary but starts over at the same generation
+    if index_dir not in _codecs or _codecs[index_dir][0] != reader_id:
+        path = os.path.join(index_dir, ZDICT_FILENAME)
+        codec = None
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                codec = BodyCodec(f.read())
+        _codecs[index_dir] = (reader_id, codec)
+    return _codecs[index_dir][1]
+
+
+def get_body(index_dir, hit):
+    # exact, stemmed and common all store the same body, or it's stored once compressed
+    fields = hit.fields()
+    if 'body_z' in fields:
+        return get_codec(index_dir, get_reader_id(hit.searcher.reader())).decompress(fields['body_z'])
+    return fields['exact']
+
+
+def get_body_stats(index_dir, ix):
+    # what compression saves in the stored fields against what reading a body back costs
+    with ix.reader() as reader:
+        codec = get_codec(index_dir, get_reader_id(reader))
+        if codec is None:
+            return None
+        num_docs = reader.doc_count()
+        all_fields = list(reader.all_stored_fields())
+    stored_bytes = raw_bytes = 0
+    seconds = 0.0
+    for fields in all_fields:
+        data = fields['body_z']
+        start = time.perf_counter()
+        text = codec._decompress(data)
+        seconds += time.perf_counter() - start
+        stored_bytes += len(data)
+        # once each for exact, stemmed and common
+        raw_bytes += 3 * len(text.encode('utf-8'))
+    return {
+        'zdict_bytes': len(codec.zdict),
+        'stored_bytes': stored_bytes,
+        'uncompressed_bytes': raw_bytes,
+        'ratio': raw_bytes / stored_bytes if stored_bytes else None,
+        'decompress_us_per_body': seconds / num_docs * 1e6 if num_docs else None,
+    }
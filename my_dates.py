@@ -0,0 +1,60 @@
+import re
+from array import array
+from datetime import datetime
+from functools import lru_cache
+
+# date keys are whole seconds since this, plus the chapter number so sessions spanning chapters stay in order
+# 0 is reserved for "no date", no session is anywhere near this old
+DATE_KEY_EPOCH = datetime(1800, 1, 1)
+DATE_KEY_END = datetime(2200, 1, 1)
+DATE_KEY_SPAN = int((DATE_KEY_END - DATE_KEY_EPOCH).total_seconds())
+NO_DATE_KEY = 0
+
+MONTHS = ('january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december')
+session_date_re = re.compile(r'\b(?P<month>{}) (?P<day>\d+)\b(?:, (?P<year>\d+))?'.format('|'.join(MONTHS)), re.IGNORECASE)
+chapter_re = re.compile(r'chapter\W*(\d+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=None)
+def parse_session_date(session):
+    # (year, month, day), year is None when the session title leaves it out
+    if not session:
+        return None
+
+    m = session_date_re.search(session)
+    if not m:
+        return None
+
+    year = int(m.group('year')) if m.group('year') else None
+    return year, MONTHS.index(m.group('month').lower()) + 1, int(m.group('day'))
+
+
+@lru_cache(maxsize=None)
+def get_chapter(heading):
+    m = chapter_re.search(heading or '')
+    return int(m.group(1)) if m else 0
+
+
+def get_date_key(date, heading):
+    if date is None:
+        return NO_DATE_KEY
+    return int((date - DATE_KEY_EPOCH).total_seconds()) + get_chapter(heading)
+
+
+def resolve_book_dates(sessions, headings):
+    # one ordered pass over a single book, no state survives between books or calls
+    # a session without a year takes it from the previous dated session of the same book
+    # todo fix these in books.py
+    dates = []
+    date_keys = array('q')
+    year = None
+    for session, heading in zip(sessions, headings):
+        parsed = parse_session_date(session)
+        date = None
+        if parsed:
+            year = parsed[0] or year
+            if year is not None:
+                date = datetime(year, parsed[1], parsed[2])
+        dates.append(date)
+        date_keys.append(get_date_key(date, heading))
+    return dates, date_keys
@@ -0,0 +1,271 @@
+import threading
+from bisect import bisect_left
+
+import numpy as np
+from whoosh.matching import ListMatcher, NullMatcher, FilterMatcher, WrappingMatcher
+from whoosh.query import AndNot, DateRange, Not, Or, Query, Term, MultiTerm, Phrase, SpanNear2
+
+RANGE_CACHE_SIZE = 512
+
+_cache = {}
+# get_reader_id() of the reader the cache was last pruned for
+_cache_reader_id = None
+# shared by the threads of a gunicorn --threads worker
+_cache_lock = threading.Lock()
+
+
+def get_reader_id(reader):
+    # whoosh starts every new index at the same generation numbers, its segment ids are new though
+    return tuple((leaf.segment().segment_id(), leaf.generation()) for leaf, _ in reader.leaf_readers())
+
+
+def get_segment_cached(reader, name, build):
+    # segment readers are reopened for every searcher, but their contents only change with the segment's generation
+    key = (reader.segment().segment_id(), reader.generation(), name)
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+    # built outside the lock, two threads may both build it but the first one stored wins
+    value = build(reader)
+    with _cache_lock:
+        return _cache.setdefault(key, value)
+
+
+def prune_segment_cache(reader):
+    # whatever was cached for segments that aren't reader's leaves, e.g. every one a rebuild replaced, goes
+    global _cache_reader_id
+    reader_id = get_reader_id(reader)
+    if reader_id == _cache_reader_id:
+        return
+    with _cache_lock:
+        leaves = set(reader_id)
+        for key in [key for key in _cache if key[:2] not in leaves]:
+            del _cache[key]
+        _cache_reader_id = reader_id
+
+
+class SortedColumn:
+    # a numeric column's values in order alongside their docnums, so any range is two binary searches
+    def __init__(self, reader, fieldname):
+        docnums = np.fromiter(reader.all_doc_ids(), dtype=np.int64)
+        values = np.fromiter(reader.column_reader(fieldname, translate=False), dtype=np.uint64)[docnums]
+        has_value = values != reader.schema[fieldname].default
+        docnums, values = docnums[has_value], values[has_value]
+
+        # mergesort is the stable one, kind='stable' needs numpy 1.15
+        order = np.argsort(values, kind='mergesort')
+        self.docnums = docnums[order]
+        self.values = values[order]
+        self.ranges = {}
+
+    def range_docs(self, start, end, startexcl=False, endexcl=False):
+        key = (start, end, startexcl, endexcl)
+        # returned from the local, another thread may clear the cache in between
+        docnums = self.ranges.get(key)
+        if docnums is None:
+            lo = 0 if start is None else np.searchsorted(self.values, np.uint64(start), side='right' if startexcl else 'left')
+            hi = len(self.values) if end is None else np.searchsorted(self.values, np.uint64(end), side='left' if endexcl else 'right')
+            if len(self.ranges) >= RANGE_CACHE_SIZE:
+                self.ranges.clear()
+            docnums = self.ranges[key] = np.sort(self.docnums[lo:hi]).tolist()
+        return docnums
+
+
+class SortedDateRange(DateRange):
+    # matches and prints exactly like DateRange, but from a sorted column instead of the field's tiered range terms
+    def _range_docs(self, reader):
+        if not reader.is_atomic():
+            return [offset + docnum for leaf, offset in reader.leaf_readers() for docnum in self._range_docs(leaf)]
+        column = get_segment_cached(reader, ('sorted', self.fieldname), lambda r: SortedColumn(r, self.fieldname))
+        return column.range_docs(self.start, self.end, self.startexcl, self.endexcl)
+
+    def simplify(self, ixreader):
+        return self
+
+    def estimate_size(self, ixreader):
+        return len(self._range_docs(ixreader))
+
+    def estimate_min_size(self, ixreader):
+        return self.estimate_size(ixreader)
+
+    def docs(self, searcher):
+        return iter(self._range_docs(searcher.reader()))
+
+    def matcher(self, searcher, context=None):
+        prune_segment_cache(searcher.get_parent().reader())
+        docnums = self._range_docs(searcher.reader())
+        if not docnums:
+            return NullMatcher()
+        return ListMatcher(docnums, all_weights=self.boost)
+
+
+class BookMasks:
+    # one docnum bitmask per book, combined bitwise for any set of book clauses
+    def __init__(self, reader, fieldname):
+        self.doc_count = reader.doc_count_all()
+        self.masks = {}
+        for btext in reader.lexicon(fieldname):
+            mask = np.zeros(self.doc_count, dtype=bool)
+            mask[list(reader.postings(fieldname, btext).all_ids())] = True
+            self.masks[btext] = mask
+        self.combined = {}
+
+    def combine(self, clauses):
+        # clauses are (book terms, boost), each book term scores its boost just like an ID field term
+        result = self.combined.get(clauses)
+        if result is None:
+            weights = np.zeros(self.doc_count)
+            for btexts, boost in clauses:
+                for btext in btexts:
+                    weights[self.masks[btext]] += boost
+            docnums = np.flatnonzero(weights)
+            result = self.combined[clauses] = docnums.tolist(), weights[docnums].tolist()
+        return result
+
+
+class BookFilter(Query):
+    # book: clauses (terms, wildcards, or an OR of them) matched from cached per-book bitmasks instead of postings
+    # the original clause stays a child so terms, tokens and corrections behave as before
+    def __init__(self, q):
+        self.q = q
+        self.fieldname = q.field() if not isinstance(q, Or) else q.subqueries[0].field()
+        self.boost = 1.0
+
+    def __unicode__(self):
+        return str(self.q)
+
+    __str__ = __unicode__
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.q)
+
+    def __eq__(self, other):
+        return other and self.__class__ is other.__class__ and self.q == other.q
+
+    def __hash__(self):
+        return hash(self.q)
+
+    def is_leaf(self):
+        return False
+
+    def children(self):
+        return [self.q]
+
+    def _clauses(self, reader):
+        if isinstance(self.q, Or):
+            subqueries, boost = self.q.subqueries, self.q.boost
+        else:
+            subqueries, boost = [self.q], 1.0
+        return tuple((frozenset(btext for _, btext in subq.existing_terms(reader, expand=True)), subq.boost * boost) for subq in subqueries)
+
+    def _matches(self, reader):
+        if not reader.is_atomic():
+            result = ([], [])
+            for leaf, offset in reader.leaf_readers():
+                docnums, weights = self._matches(leaf)
+                result[0].extend(offset + docnum for docnum in docnums)
+                result[1].extend(weights)
+            return result
+        masks = get_segment_cached(reader, ('books', self.fieldname), lambda r: BookMasks(r, self.fieldname))
+        return masks.combine(self._clauses(reader))
+
+    def estimate_size(self, ixreader):
+        return len(self._matches(ixreader)[0])
+
+    def estimate_min_size(self, ixreader):
+        return self.estimate_size(ixreader)
+
+    def matcher(self, searcher, context=None):
+        prune_segment_cache(searcher.get_parent().reader())
+        docnums, weights = self._matches(searcher.reader())
+        if not docnums:
+            return NullMatcher()
+        if len(set(weights)) == 1:
+            return ListMatcher(docnums, all_weights=weights[0])
+        return ListMatcher(docnums, weights=weights)
+
+
+class CandidateMatcher(FilterMatcher):
+    # a FilterMatcher that skips straight to the next candidate instead of stepping through every posting in between
+    def __init__(self, child, ids, exclude=False, boost=1.0):
+        self._sorted_ids = sorted(ids)
+        FilterMatcher.__init__(self, child, ids, boost=boost)
+
+    def is_active(self):
+        return self.child.is_active() and self.child.id() <= self._sorted_ids[-1]
+
+    def _find_next(self):
+        child = self.child
+        r = False
+        while self.is_active() and child.id() not in self._ids:
+            r = child.skip_to(self._sorted_ids[bisect_left(self._sorted_ids, child.id())]) or r
+        return r
+
+
+class PairedPhrase(Phrase):
+    # an exact phrase narrowed to the documents holding every adjacent word pair first, see my_index.pairs_fields
+    # so positions are only read for those, and scores come from the same word matchers as Phrase
+    def matcher(self, searcher, context=None):
+        pairs_fieldname = self.fieldname + '_pairs'
+        if self.slop != 1 or len(self.words) < 2 or pairs_fieldname not in searcher.schema:
+            return Phrase.matcher(self, searcher, context)
+
+        reader = searcher.reader()
+        field = searcher.schema[self.fieldname]
+        words = [field.to_bytes(word) for word in self.words]
+        pairs = [b' '.join(pair) for pair in zip(words, words[1:])]
+        if any((self.fieldname, word) not in reader for word in words) or any((pairs_fieldname, pair) not in reader for pair in pairs):
+            return NullMatcher()
+
+        # rarest pair first
+        pairs.sort(key=lambda pair: reader.doc_frequency(pairs_fieldname, pair))
+        candidates = set(reader.postings(pairs_fieldname, pairs[0]).all_ids())
+        for pair in pairs[1:]:
+            candidates.intersection_update(reader.postings(pairs_fieldname, pair).all_ids())
+            if not candidates:
+                return NullMatcher()
+
+        ms = [CandidateMatcher(Term(self.fieldname, word).matcher(searcher, context), candidates) for word in words]
+        m = SpanNear2.SpanNear2Matcher(ms, slop=self.slop, ordered=True, mindist=1)
+        if self.boost != 1.0:
+            m = WrappingMatcher(m, boost=self.boost)
+        return m
+
+
+def is_book_clause(q):
+    # a wildcard's own boost doesn't score like a term's, so leave those to Whoosh
+    is_scored_alike = isinstance(q, Term) or (isinstance(q, MultiTerm) and q.boost == 1.0)
+    return is_scored_alike and q.field() == 'book'
+
+
+def without_fast_filters(q):
+    def restore(subq):
+        if isinstance(subq, BookFilter):
+            return subq.q
+        if type(subq) is SortedDateRange:
+            return DateRange(subq.fieldname, subq.startdate, subq.enddate, subq.startexcl, subq.endexcl,
+                             boost=subq.boost, constantscore=subq.constantscore)
+        return subq
+    return q.accept(restore)
+
+
+def with_fast_filters(q):
+    def replace(subq):
+        # negated, a mask's ListMatcher gives TopCollector wrong quality bounds and the top N misses hits,
+        # so anything under NOT or ANDNOT stays as Whoosh's own query
+        if type(subq) is Not:
+            return subq.apply(without_fast_filters)
+        if type(subq) is AndNot:
+            return AndNot(subq.a, without_fast_filters(subq.b))
+        if type(subq) is DateRange:
+            return SortedDateRange(subq.fieldname, subq.startdate, subq.enddate, subq.startexcl, subq.endexcl,
+                                   boost=subq.boost, constantscore=subq.constantscore)
+        if is_book_clause(subq):
+            return BookFilter(subq)
+        # an OR of only book clauses is a single union of masks, e.g. book:(ss OR nopr OR tma)
+        if type(subq) is Or and not subq.minmatch and subq.scale is None and all(isinstance(c, BookFilter) for c in subq.subqueries):
+            return BookFilter(Or([c.q for c in subq.subqueries], boost=subq.boost))
+        if type(subq) is Phrase:
+            return PairedPhrase(subq.fieldname, subq.words, slop=subq.slop, boost=subq.boost, char_ranges=subq.char_ranges)
+        return subq
+    return q.accept(replace)
@@ -3,20 +3,29 @@ import re
 import urllib.parse
 import html
 import os
+import glob
+import hashlib
+import json
+from datetime import datetime
 
 from CommonMark import commonmark
 from bs4 import BeautifulSoup
-from flask import request, render_template, redirect, url_for
+from flask import request, render_template, redirect, url_for, make_response
+from werkzeug.http import is_resource_modified
 from whoosh import highlight
-from whoosh.qparser import QueryParser
-from whoosh.qparser.dateparse import DateParserPlugin
 from whoosh.query.qcore import NullQuery
 from whoosh.scoring import BM25F
 
 import my_index
 from books import Books
-from my_whoosh import ParagraphFragmenter, ConsistentFragmentScorer, DescDateBM25F, AscDateBM25F, get_sentence_fragments, HtmlNumberedParagraphFormatter
+from my_body import get_body
+from my_headings import get_heading
+from my_index import parse_query, DEFAULT_FIELD, HIGHLIGHT_FIELDS
+from my_snapshots import get_snapshot
+from my_suggest import get_suggester
+from my_whoosh import ParagraphFragmenter, ConsistentFragmentScorer, DescDateBM25F, AscDateBM25F, get_sentence_fragments, HtmlNumberedParagraphFormatter, PinpointHighlighter
 from __init__ import app
+import my_assets  # registers the precompressed asset route
 
 # occasionally a single session straddles 2 chapters, which are different hits
 MAXIMUM_SAME_SESSION_HITS = 2
@@ -25,7 +34,7 @@ HITS_PER_LISTING_PAGE = 150
 MULTIPLE_HIT_EXCERPT_LIMIT = 3
 SINGLE_HIT_EXCERPT_LIMIT = 50    # effectively ALL of them, I would think
 HIT_EXPOSED_EXCERPT_LIMIT = 10
-DEFAULT_FIELD = 'stemmed'
+INDEX_DIR = 'index'
 
 @app.template_filter('volumes_link')
 def get_html_book_link(tpl):
@@ -123,9 +132,8 @@ def urlize(s, in_href=False, undo=False):
 @app.route('/q/<q_query>/h/<hit_order>/e/<excerpt_order>/', methods=['GET', 'POST'])
 @app.route('/q/<q_query>/h/<hit_order>/e/<excerpt_order>/<page_num>/', methods=['GET', 'POST'])
 def search_form(os_query=None, q_query=None, hit_order=None, excerpt_order=None, page_num=None):
-    global result_type, hit_extras
+    global result_type
     result_type = ""
-    hit_extras.clear()
     url_state.update(locals().copy())
 
     # redirect POST to GET
@@ -145,15 +153,58 @@ def search_form(os_query=None, q_query=None, hit_order=None, excerpt_order=None,
             url_state['page_num'] = None
         if os_query or order_was_bad or num_was_bad:
             return stateful_redirect('search_form')
-        
+
+        # pages are deterministic for a given url, index build and app version, so a repeat visit needn't search at all
+        build_id = my_index.get_build_id(ix)
+        etag, last_modified = get_page_validators(build_id)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return with_page_validators(app.response_class(status=304), etag, last_modified)
+        # pre-rendered by cli.py --snapshots
+        snapshot = get_snapshot((build_id, app_version), request.host, request.path)
+        if snapshot is not None:
+            return with_page_validators(make_response(snapshot), etag, last_modified)
+
         if not url_state['q_query']:
-            return render_template("search-form.html", **url_state, books=Books.indexed, doc_count=ix.doc_count())
+            response = make_response(render_template("search-form.html", **url_state, books=Books.indexed, doc_count=ix.doc_count()))
+        else:
+            # in a GET the ? is stripped, even if it's before a /, so must always use %3F for the GET url (urlize(undo=False))
+            # but oddly enough flask here shows it as ? even though it keeps e.g. + for spaces, so we put it back to %3F
+            url_state['q_query'] = url_state['q_query'].replace('?', '%3F')
+            query_str = urlize(url_state['q_query'], undo=True)
+            response = make_response(search_whoosh(query_str))
+        if response.status_code == 200:
+            with_page_validators(response, etag, last_modified)
+        return response
+
+
+def get_page_validators(build_id):
+    generation, index_modified = build_id
+    etag = hashlib.sha1('{}\n{}\n{}\n{}'.format(generation, index_modified, app_version, request.url).encode('utf-8')).hexdigest()
+    last_modified = datetime.utcfromtimestamp(int(max(index_modified, app_modified)))
+    return etag, last_modified
+
 
-        # in a GET the ? is stripped, even if it's before a /, so must always use %3F for the GET url (urlize(undo=False))
-        # but oddly enough flask here shows it as ? even though it keeps e.g. + for spaces, so we put it back to %3F
-        url_state['q_query'] = url_state['q_query'].replace('?', '%3F')
-        query_str = urlize(url_state['q_query'], undo=True)
-        return search_whoosh(query_str)
+def get_app_version():
+    # a deploy that changes code, templates or assets changes the pages too, even with the same index
+    paths = sorted(glob.glob('*.py') + glob.glob('templates/*') + glob.glob('static/gen/manifest.json'))
+    mtimes = [os.path.getmtime(path) for path in paths]
+    return hashlib.sha1(repr(list(zip(paths, mtimes))).encode('utf-8')).hexdigest(), max(mtimes)
+
+
+def with_page_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # shared caches may keep it but must revalidate, which is cheap
+    response.headers['Cache-Control'] = 'public, no-cache'
+    return response
+
+
+# OpenSearch suggestions, see static/sethcorpus.osdd
+@app.route('/suggest/')
+def suggest():
+    query = request.args.get('q', '')
+    suggestions = get_suggester(ix).suggest(query)
+    return app.response_class(json.dumps([query, suggestions]), mimetype='application/x-suggestions+json')
 
 
 def get_valid_order(hit_order, excerpt_order):
@@ -186,11 +237,9 @@ def search_whoosh(query_str):
         if to_session:
             return pretty_redirect(get_optimal_session_url(searcher, query_str))
 
-        qp = QueryParser(DEFAULT_FIELD, my_index.search_schema)
-        qp.add_plugin(DateParserPlugin())
         # todo this is pretty ugly
         try:
-            qp = qp.parse(query_str)
+            qp = parse_query(DEFAULT_FIELD, query_str)
         except:
             dateless_query = re.sub(r'\bdate:\[.*\]', r'', query_str, re.IGNORECASE)
             return stateful_redirect('search_form', q_query=urlize(dateless_query) or None)
@@ -199,7 +248,7 @@ def search_whoosh(query_str):
             return stateful_redirect('search_form', q_query=None)
 
         highlight_field = None
-        for field in ('exact', 'common', 'stemmed'):
+        for field in HIGHLIGHT_FIELDS:
             if field + ':' in str(qp):
                 highlight_field = field
                 break
@@ -238,9 +287,7 @@ def remove_redundant_sorting():
 
 
 def get_html_correction(searcher, query_str, qp):
-    exact_qp = QueryParser('exact', my_index.search_schema)
-    exact_qp.add_plugin(DateParserPlugin())
-    exact_qp = exact_qp.parse(query_str)
+    exact_qp = parse_query('exact', query_str)
     try:
         corrected_query = searcher.correct_query(exact_qp, query_str, prefix=1)
     except:
@@ -258,9 +305,7 @@ def get_html_correction(searcher, query_str, qp):
         if re.search(r'\W', token.original):
             token.text = token.original
     corrected_query_str = replace_tokens(query_str, corrected_query.tokens)
-    corrected_qp = QueryParser('stemmed', my_index.search_schema)
-    corrected_qp.add_plugin(DateParserPlugin())
-    corrected_qp = corrected_qp.parse(corrected_query_str)
+    corrected_qp = parse_query('stemmed', corrected_query_str)
     if corrected_qp == qp:
         return ""
 
@@ -299,7 +344,7 @@ def get_html_pagination(page_results):
 def get_optimal_session_url(searcher, query_str):
     hit_order = None
     shorter_query = re.sub(r'\bsession:"(\d+)[^"]+"', r'session:\1', query_str)
-    qp = QueryParser(DEFAULT_FIELD, my_index.search_schema).parse(shorter_query)
+    qp = parse_query(DEFAULT_FIELD, shorter_query)
     # the limit is purely for efficiency
     results = searcher.search(qp, limit=MAXIMUM_SAME_SESSION_HITS + 1)
     if all_same_session(results):
@@ -312,27 +357,19 @@ def get_optimal_session_url(searcher, query_str):
 
 
 def all_same_session(results):
-    result = all(results[0]['session'] == hit['session'] for hit in results)
+    result = all(get_heading(results[0]).session == get_heading(hit).session for hit in results)
     return result
 
 
-def update_hit_extras(hit, highlights):
-    global hit_extras
-    extras = {
-        'num_highlight_p': highlights.count('\n'),
-        'num_doc_p': len(re.findall(r'\n{2,}', hit['exact'].strip())),
-    }
-    extras['coverage'] = extras['num_highlight_p'] / extras['num_doc_p']
-    hit_extras[(hit.docnum, hit.results.q)] = extras
-
-
-def extras(hit):
-    return hit_extras[(hit.docnum, hit.results.q)]
+def get_doc_stats(hit):
+    reader = hit.searcher.reader()
+    num_doc_p, body_len = (reader.column_reader(fieldname)[hit.docnum] for fieldname in ('num_doc_p', 'body_len'))
+    return num_doc_p, body_len
 
 
-def is_exposed(hit):
-    is_long = len(hit['exact']) > 1500
-    is_high_coverage = extras(hit)['coverage'] > 0.5 or extras(hit)['num_highlight_p'] == SINGLE_HIT_EXCERPT_LIMIT
+def is_exposed(body_len, num_highlight_p, num_doc_p):
+    is_long = body_len > 1500
+    is_high_coverage = num_highlight_p / num_doc_p > 0.5 or num_highlight_p == SINGLE_HIT_EXCERPT_LIMIT
     return 'single' in result_type and is_long and is_high_coverage
 
 
@@ -346,10 +383,11 @@ def get_html_results(query_str, qp, page_results, highlight_field):
                                                                                  page_results.offset + page_results.pagelen, page_results.total, qp)
     result += heading
 
-    page_results.results.fragmenter = ParagraphFragmenter()
-    page_results.results.order = highlight.FIRST if computed_excerpt_order() == 'pos' else highlight.SCORE
-    page_results.results.scorer = ConsistentFragmentScorer()
-    page_results.results.formatter = HtmlNumberedParagraphFormatter(id_tag=r'<span id="{}" class="hash"></span>', between='')
+    page_results.results.highlighter = PinpointHighlighter(
+        fragmenter=ParagraphFragmenter(),
+        scorer=ConsistentFragmentScorer(),
+        formatter=HtmlNumberedParagraphFormatter(id_tag=r'<span id="{}" class="hash"></span>', between=''),
+        order=highlight.FIRST if computed_excerpt_order() == 'pos' else highlight.SCORE)
 
     result += '<div class="{}">'.format(result_type)
     for hit_idx, hit in enumerate(page_results):
@@ -371,25 +409,28 @@ def get_html_hit(query_str, highlight_field, page_results, hit_idx):
     hit = page_results[hit_idx]
     result = '<div class="hit">\n'
 
-    html_hit_link = get_single_session_url(query_str, hit)
-    html_hit_heading = get_html_hit_heading(result_type, "hit-{}".format(hit_idx), hit, html_hit_link)
+    heading = get_heading(hit)
+    html_hit_link = get_single_session_url(query_str, heading)
+    html_hit_heading = get_html_hit_heading(result_type, "hit-{}".format(hit_idx), heading, html_hit_link)
 
     html_excerpts = ""
     if 'single' in result_type or result_type == 'multiple':
         limit = SINGLE_HIT_EXCERPT_LIMIT if 'single' in result_type else MULTIPLE_HIT_EXCERPT_LIMIT + 1
-        highlights = hit.highlights(highlight_field or DEFAULT_FIELD, top=limit)
-        update_hit_extras(hit, highlights)
+        highlights = hit.highlights(highlight_field or DEFAULT_FIELD, text=get_body(INDEX_DIR, hit), top=limit)
+        num_highlight_p = highlights.count('\n')
+        num_doc_p, body_len = get_doc_stats(hit)
+        exposed = is_exposed(body_len, num_highlight_p, num_doc_p)
 
         if 'single' in result_type:
             html_coverage = '<span class="coverage" title="excerpts/paragraphs">{}/{} ({}%)</span>'.format(
-                extras(hit)['num_highlight_p'], extras(hit)['num_doc_p'], round(extras(hit)['coverage'] * 100))
+                num_highlight_p, num_doc_p, round(num_highlight_p / num_doc_p * 100))
             html_hit_heading = html_hit_heading.replace('<!--coverage-->', html_coverage)
-        if is_exposed(hit):
+        if exposed:
             if computed_excerpt_order() != 'rel':
                 raise RelevantExcerptsBuriedError
             result += """<h4>These excerpts have been reduced due to the original results revealing too much of the copyrighted work.<br />
             For more complete excerpts it may be necessary to use less common terms.</h4>\n"""
-        html_excerpts = get_html_excerpts(page_results, hit_idx, html_hit_link, highlights)
+        html_excerpts = get_html_excerpts(page_results, hit_idx, html_hit_link, highlights, num_doc_p, exposed)
 
     result += html_hit_heading
     result += html_excerpts
@@ -428,9 +469,11 @@ def get_html_hit_heading(result_type, hit_id, hit, html_hit_link):
 def get_html_more_like(results):
     try:
         if results.total == 1:
-            similar_results = results[0].searcher.more_like(results[0].docnum, 'exact', top=5)
+            # the same key terms as from the stored field, which a compressed index doesn't have
+            text = get_body(INDEX_DIR, results[0])
+            similar_results = results[0].searcher.more_like(results[0].docnum, 'exact', text=text, top=5)
         else:
-            text = ''.join(h['exact'] for h in results)
+            text = ''.join(get_body(INDEX_DIR, h) for h in results)
             similar_results = results[0].searcher.more_like(None, 'exact', text=text, top=5)
     except:
         return ""
@@ -439,20 +482,20 @@ def get_html_more_like(results):
     result += '<h2>Similar sessions</h2>\n'
     for hit_idx, hit in enumerate(similar_results):
         result += '<div class="similar-hit">\n'
-        heading = get_html_hit_heading('listing', 'similar-{}'.format(hit_idx), hit, None)
+        heading = get_html_hit_heading('listing', 'similar-{}'.format(hit_idx), get_heading(hit), None)
         result += heading
         result += '</div>\n'
     result += '</div>\n'
     return result
 
 
-def get_html_excerpts(page_results, hit_idx, hit_link, highlights):
+def get_html_excerpts(page_results, hit_idx, hit_link, highlights, num_doc_p, exposed):
     global og_description
     hit = page_results[hit_idx]
     p_num_last = 0
     result = ""
     for p_idx, cm_paragraph in enumerate(filter(None, highlights.split('\n'))):
-        if is_exposed(hit) and p_idx == HIT_EXPOSED_EXCERPT_LIMIT:
+        if exposed and p_idx == HIT_EXPOSED_EXCERPT_LIMIT:
             break
 
         if result_type == 'multiple' and p_idx == MULTIPLE_HIT_EXCERPT_LIMIT:
@@ -473,7 +516,7 @@ def get_html_excerpts(page_results, hit_idx, hit_link, highlights):
             update_og_description(page_results.total, paragraph)
 
         is_first_hit_preview = page_results.pagenum == 1 and hit_idx == 0
-        gets_full_paragraph = ('single' in result_type or is_first_hit_preview) and not is_exposed(hit)
+        gets_full_paragraph = ('single' in result_type or is_first_hit_preview) and not exposed
         if not gets_full_paragraph:
             sentences = get_sentence_fragments(paragraph)
             paragraph = get_html_fragmented_paragraph(hit_link, p_num, sentences)
@@ -485,7 +528,7 @@ def get_html_excerpts(page_results, hit_idx, hit_link, highlights):
             paragraph = '<div data-content="{}{}"></div>{}'.format('¶', p_num, paragraph)
         result += '{}\n'.format(paragraph)
 
-    p_remaining_count = extras(hit)['num_doc_p'] - p_num_last
+    p_remaining_count = num_doc_p - p_num_last
     if readable_layout() and p_remaining_count:
         result += '\n<p>[... {} paragraph{} ...]</p>\n'.format(p_remaining_count, 's' if p_remaining_count > 1 else '')
     result = '<div class="excerpts {}">\n{}</div>\n'.format('excerpts-readable' if readable_layout() else 'excerpts-numbered', result)
@@ -538,7 +581,6 @@ def load_uk_us_variations():
 
 
 url_state = {}
-hit_extras = {}
 result_type = ''
 og_description = ""
 uk_variations = {}
@@ -546,4 +588,7 @@ us_variations = {}
 uk_us_variations = set()
 os.chdir(app.root_path)
 load_uk_us_variations()
-ix = my_index.get_idx('index')
\ No newline at end of file
+app_version, app_modified = get_app_version()
+ix = my_index.get_idx(INDEX_DIR)
+# rather than in the first /suggest/ request
+get_suggester(ix)
\ No newline at end of file
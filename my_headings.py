@@ -0,0 +1,51 @@
+import sys
+from bisect import bisect_right
+from collections import namedtuple
+
+from my_filters import get_segment_cached, prune_segment_cache
+
+# everything get_html_hit_heading() and get_single_session_url() read of a hit
+BOOK_FIELDS = ('book_abbr', 'book_name', 'book_tree', 'book_kindle')
+Book = namedtuple('Book', BOOK_FIELDS)
+
+# one per book, shared by every segment and shard
+_books = {}
+
+
+def get_book(fields):
+    key = tuple(fields[fieldname] for fieldname in BOOK_FIELDS)
+    if key not in _books:
+        _books[key] = Book(*key)
+    return _books[key]
+
+
+class Heading:
+    # subscriptable like a hit, so the heading functions take either
+    __slots__ = ('book', 'short', 'long', 'session', 'key_terms')
+
+    def __init__(self, fields):
+        self.book = get_book(fields)
+        self.short = fields['short']
+        self.long = fields['long']
+        self.session = fields['session']
+        # the same few thousand terms recur across sessions
+        self.key_terms = tuple(sys.intern(key_term) for key_term in fields.get('key_terms', ()))
+
+    def __getitem__(self, fieldname):
+        return getattr(self.book if fieldname in BOOK_FIELDS else self, fieldname)
+
+
+def get_segment_headings(reader):
+    # by segment docnum, unpickling each stored record once per index generation rather than on every page
+    result = [None] * reader.doc_count_all()
+    for docnum, fields in reader.iter_docs():
+        result[docnum] = Heading(fields)
+    return result
+
+
+def get_heading(hit):
+    reader = hit.searcher.reader()
+    prune_segment_cache(reader)
+    leaves = reader.leaf_readers()
+    leaf, offset = leaves[bisect_right([offset for _, offset in leaves], hit.docnum) - 1]
+    return get_segment_cached(leaf, 'headings', get_segment_headings)[hit.docnum - offset]
@@ -1,14 +1,24 @@
+import multiprocessing
 import os
 import re
-from datetime import datetime
-
-from whoosh import index, analysis
-from whoosh.analysis import StandardAnalyzer, StemmingAnalyzer, STOP_WORDS, CharsetFilter
-from whoosh.fields import ID, TEXT, Schema, STORED, DATETIME
+import shutil
+import time
+
+from whoosh import index
+from whoosh.analysis import StandardAnalyzer, StemmingAnalyzer, STOP_WORDS, CharsetFilter, BiWordFilter
+from whoosh.fields import ID, TEXT, Schema, STORED, DATETIME, NUMERIC
+from whoosh.qparser import QueryParser
+from whoosh.qparser.dateparse import DateParserPlugin
 from whoosh.support.charset import accent_map
 
 from books import Books
 from mod_whoosh import CleanupStandardAnalyzer, CleanupStemmingAnalyzer
+from my_dates import resolve_book_dates
+from my_body import BodyCodec, train_zdict, write_zdict, ZDICT_FILENAME
+from my_filters import with_fast_filters
+from my_key_terms import KeyTerms
+from my_stats import RebuildTimer
+from my_shards import ShardedIndex, SHARDS_DIR, is_sharded, get_shard_dirs
 
 
 # todo manually search for and fix these where a misplaced asterisk breaks italics: \*[^*]*? \*
@@ -36,8 +46,9 @@ def clean_heading(_text):
     return text
 
 
-def add_document(writer, d, tiers, content):
+def get_document(d, tiers, content):
     assert(len(tiers) == 3)
+    doc = dict(d)
 
     # everything but session
     doc_heading = []
@@ -45,76 +56,76 @@ def add_document(writer, d, tiers, content):
         doc_heading.append(tier['short'])
         doc_heading.append(tier['long'])
     doc_heading.append(tiers[2]['long'])
-    d['heading'] = ' '.join(filter(None, doc_heading))
+    doc['heading'] = ' '.join(filter(None, doc_heading))
 
     # short form headings, use general if specific doesn't exist
     doc_short = [tiers[1]['short'] if tiers[1]['short'] else tiers[0]['short'],
                  tiers[2]['short']]
-    d['short'] = ': '.join(filter(None, doc_short))
+    doc['short'] = ': '.join(filter(None, doc_short))
 
     # all the long form headings
-    d['long'] = ''.join(["- {}<br />".format(tier['long']) for tier in tiers if tier['long']])
-
-    d['session'] = tiers[2]['short']
-    d['date'] = get_date_from_session(d['session'])
-    d['key_terms_content'] = content
-    print("{}\t{}\t{}".format(d['book_abbr'], d['heading'], d['session']))
-    writer.add_document(**d)
-
-
-last_date = None
-def get_date_from_session(session):
-    global last_date
-    if not session:
-        return None
-
-    m = re.search(r'\b(?:january|february|march|april|may|june|july|august|september|october|november|december) \d+\b(?:, (?P<year>\d+))?', session, re.IGNORECASE)
-    if not m:
-        return None
-
-    date_str = m.group(0)
-    if not m.group('year'):
-        # todo fix these in books.py, get rid of last_date hack
-        print(last_date.date(), session)
-        date_str += ", {}".format(last_date.year)
-
-    result = datetime.strptime(date_str, '%B %d, %Y')
-    last_date = result
+    doc['long'] = ''.join(["- {}<br />".format(tier['long']) for tier in tiers if tier['long']])
+
+    doc['session'] = tiers[2]['short']
+    doc['key_terms_content'] = content
+    # so paragraph coverage and exposure never need to load the body at search time
+    doc['num_doc_p'] = len(re.findall(r'\n{2,}', content.strip()))
+    doc['body_len'] = len(content)
+    return doc
+
+
+def add_book_documents(writer, docs):
+    # dates are resolved for the whole book at once since some sessions rely on their predecessors for the year
+    with timer.stage('split'):
+        dates, date_keys = resolve_book_dates([doc['session'] for doc in docs], [doc['heading'] for doc in docs])
+    for doc, date, date_key in zip(docs, dates, date_keys):
+        doc['date'] = date
+        doc['date_key'] = date_key
+        with timer.stage('write'):
+            writer.add_document(**doc)
+
+
+def get_doc_key_terms(reader, collection=None):
+    with timer.stage('key terms'):
+        key_terms = KeyTerms(reader, 'key_terms_content', numterms=10, collection=collection)
+        result = {}
+        for doc_num in reader.all_doc_ids():
+            m = re.search(r'session (\d+)', reader.stored_fields(doc_num)['session'], flags=re.IGNORECASE)
+            result[doc_num] = key_terms.for_document(doc_num, m.group(1) if m else None)
     return result
 
 
-def add_key_terms(ix):
+def add_key_terms(ix, doc_key_terms=None, codec=None):
     s = ix.searcher()
     w = ix.writer()
-    stemmer = analysis.StemmingAnalyzer()
-
-    print("Adding key terms...")
-    last_book = None
-    for doc_num in s.document_numbers():
-        fields = s.stored_fields(doc_num)
-        if fields['book_name'] != last_book:
-            last_book = fields['book_name']
-            print(last_book)
-        m = re.search(r'session (\d+)', fields['session'], flags=re.IGNORECASE)
-        is_session_num = lambda k: re.match(r'{0}(st|nd|rd|th)?'.format(m.group(1)), k) if m else False
-        key_terms = [k for k, v in s.key_terms([doc_num], 'key_terms_content', numterms=10) if not is_session_num(k)]
-        stemmed = [t.text for t in stemmer(' '.join(key_terms))]
-
-        final_terms = []
-        final_stemmed = set()
-        for (term, stemmed_term) in zip(key_terms, stemmed):
-            if stemmed_term not in final_stemmed:
-                final_terms.append(term)
-                final_stemmed.add(stemmed_term)
-
-        fields['key_terms'] = final_terms
-        fields['stemmed'] = fields['key_terms_content']
-        fields['exact'] = fields['key_terms_content']
-        fields['common'] = fields['key_terms_content']
-        del fields['key_terms_content']
-        w.delete_document(doc_num)
-        w.add_document(**fields)
-    w.commit()
+
+    if doc_key_terms is None:
+        doc_key_terms = get_doc_key_terms(s.reader())
+    with timer.stage('read'):
+        columns = {fieldname: list(s.reader().column_reader(fieldname)) for fieldname in column_fields}
+    with timer.analysis(w):
+        for doc_num in s.document_numbers():
+            with timer.stage('read'):
+                fields = s.stored_fields(doc_num)
+            # columns aren't stored fields, carry them over ourselves
+            for fieldname, column in columns.items():
+                fields[fieldname] = column[doc_num]
+            fields['key_terms'] = doc_key_terms[doc_num]
+            fields['stemmed'] = fields['key_terms_content']
+            fields['exact'] = fields['key_terms_content']
+            fields['common'] = fields['key_terms_content']
+            for fieldname in pairs_fields:
+                if fieldname in ix.schema:
+                    fields[fieldname] = fields['key_terms_content']
+            if codec:
+                with timer.stage('compress'):
+                    fields['body_z'] = codec.compress(fields['key_terms_content'])
+            del fields['key_terms_content']
+            with timer.stage('write'):
+                w.delete_document(doc_num)
+                w.add_document(**fields)
+    with timer.stage('commit'):
+        w.commit()
 
 
 def title(_text):
@@ -159,7 +170,27 @@ search_schema = Schema(book=ID(),
                        )
 
 
-def create_index(index_dir):
+# unqualified query words, and the fields that have excerpts in order of preference, for my_flask and my_batch
+DEFAULT_FIELD = 'stemmed'
+HIGHLIGHT_FIELDS = ('exact', 'common', 'stemmed')
+
+
+def parse_query(fieldname, query_str):
+    qp = QueryParser(fieldname, search_schema)
+    qp.add_plugin(DateParserPlugin())
+    return with_fast_filters(qp.parse(query_str))
+
+
+# numeric columns without a stored value
+column_fields = ('date_key', 'num_doc_p', 'body_len')
+# quiet unless cli.py asks for progress
+timer = RebuildTimer()
+# every adjacent word pair of <field> as <field>_pairs, for my_filters.PairedPhrase, empty to index without them
+pairs_fields = ('exact_pairs', 'stemmed_pairs')
+
+
+def create_index(index_dir, books=None, compress=False):
+    # compress stores the body once as body_z rather than as each of exact, stemmed and common, see my_body.py
     schema = Schema(book_abbr=STORED(),
                     book_name=STORED(),
                     book_tree=STORED(),
@@ -172,61 +203,89 @@ def create_index(index_dir):
                     heading=TEXT(stored=True, analyzer=StemmingAnalyzer(minsize=1, stoplist=None) | CharsetFilter(accent_map)),
                     session=TEXT(stored=True, analyzer=StandardAnalyzer(minsize=1, stoplist=None)),
                     date=DATETIME(stored=True, sortable=True),
-                    exact=TEXT(stored=True, analyzer=CleanupStandardAnalyzer(analyzer_re, stoplist=None) | CharsetFilter(accent_map)),
-                    stemmed=TEXT(stored=True, analyzer=CleanupStemmingAnalyzer(analyzer_re) | CharsetFilter(accent_map)),
-                    common=TEXT(stored=True, analyzer=CleanupStemmingAnalyzer(analyzer_re, stoplist=None) | CharsetFilter(accent_map)),
+                    date_key=NUMERIC(bits=64, sortable=True),
+                    num_doc_p=NUMERIC(sortable=True),
+                    body_len=NUMERIC(sortable=True),
+                    # chars=True so PinpointHighlighter can read match offsets instead of re-analyzing
+                    exact=TEXT(stored=not compress, chars=True, analyzer=CleanupStandardAnalyzer(analyzer_re, stoplist=None) | CharsetFilter(accent_map)),
+                    stemmed=TEXT(stored=not compress, chars=True, analyzer=CleanupStemmingAnalyzer(analyzer_re) | CharsetFilter(accent_map)),
+                    common=TEXT(stored=not compress, chars=True, analyzer=CleanupStemmingAnalyzer(analyzer_re, stoplist=None) | CharsetFilter(accent_map)),
                     )
+    if compress:
+        schema.add('body_z', STORED())
+    for fieldname in pairs_fields:
+        # the same tokens as the field itself, so a phrase's adjacent words are the same pairs
+        analyzer = schema[fieldname[:-len('_pairs')]].analyzer | BiWordFilter(sep=' ')
+        schema.add(fieldname, TEXT(phrase=False, analyzer=analyzer))
 
     ix = index.create_in(index_dir, schema)
 
     writer = ix.writer()
-    for book in Books.indexed:
-        with open("books/{}.txt".format(book['abbr']), encoding='utf-8') as f:
-            text = pre_process_book(book, f.read())
+    with timer.analysis(writer):
+        for book in books or Books.indexed:
+            add_book(writer, book)
+    with timer.stage('commit'):
+        writer.commit()
+    return ix
+
+
+def add_book(writer, book):
+    start = time.perf_counter()
+    path = "books/{}.txt".format(book['abbr'])
+    with timer.stage('read'):
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+    with timer.stage('pre-process'):
+        text = pre_process_book(book, text)
         text = re.search(book['book_re'], text, flags=re.DOTALL).group(1)
 
-        d = {
-            'book_name': book['name'],
-            'book_abbr': book['abbr'],
-            'book_tree': book['tree'],
-            'book_kindle': book['kindle'],
-            'book': book['abbr'].lower(),
-        }
-
-        i = 0
-        heading_tiers = [{'short': '', 'long': ''}] * 3
-        carry_over_heading = None
-        headings = list(filter(None, book['headings_re'].split(text)[1:]))
-        for (__heading, _content) in zip(headings[::2], headings[1::2]):
-            content = __heading + _content
-            if carry_over_heading:
-                content = carry_over_heading + content
-                carry_over_heading = None
-
-            heading = clean_heading(__heading)
-            if 'heading_replacements' in book:
-                for (pattern, repl) in book['heading_replacements']:
-                    heading = pattern.sub(repl, heading, 1)
-
-            update_heading_tiers(book, heading_tiers, heading)
-
-            has_content = re.search(r'[a-z]', _content)
-            if not has_content:
-                carry_over_heading = content
-                continue
-
-            add_document(writer, d, heading_tiers, content)
-            i += 1
-        print(i)
-
-    writer.commit()
-    return ix
+    d = {
+        'book_name': book['name'],
+        'book_abbr': book['abbr'],
+        'book_tree': book['tree'],
+        'book_kindle': book['kindle'],
+        'book': book['abbr'].lower(),
+    }
+
+    with timer.stage('split'):
+        docs = get_book_documents(book, text, d)
+    add_book_documents(writer, docs)
+    timer.book_done(book['abbr'], len(docs), os.path.getsize(path), time.perf_counter() - start)
+
+
+def get_book_documents(book, text, d):
+    docs = []
+    heading_tiers = [{'short': '', 'long': ''}] * 3
+    carry_over_heading = None
+    headings = list(filter(None, book['headings_re'].split(text)[1:]))
+    for (__heading, _content) in zip(headings[::2], headings[1::2]):
+        content = __heading + _content
+        if carry_over_heading:
+            content = carry_over_heading + content
+            carry_over_heading = None
+
+        heading = clean_heading(__heading)
+        if 'heading_replacements' in book:
+            for (pattern, repl) in book['heading_replacements']:
+                heading = pattern.sub(repl, heading, 1)
+
+        update_heading_tiers(book, heading_tiers, heading)
+
+        has_content = re.search(r'[a-z]', _content)
+        if not has_content:
+            carry_over_heading = content
+            continue
+
+        docs.append(get_document(d, heading_tiers, content))
+    return docs
 
 
 def get_idx(index_dir):
     if not os.path.isdir(index_dir):
         os.mkdir(index_dir)
 
+    if is_sharded(index_dir):
+        return ShardedIndex(index_dir)
     try:
         ix = index.open_dir(index_dir)
     except index.EmptyIndexError:
@@ -234,7 +293,93 @@ def get_idx(index_dir):
     return ix
 
 
-def new_index(index_dir):
-    ix = create_index(index_dir)
-    add_key_terms(ix)
+def get_build_id(ix):
+    # changes with every commit, even a rebuild's, which starts over at the same generation numbers in a new toc
+    return ix.latest_generation(), ix.last_modified()
+
+
+def new_index(index_dir, compress=False):
+    # or get_idx() would still open the old shards
+    shutil.rmtree(os.path.join(index_dir, SHARDS_DIR), ignore_errors=True)
+    remove_zdict(index_dir)
+    ix = create_index(index_dir, compress=compress)
+    add_key_terms(ix, codec=new_codec(index_dir, ix) if compress else None)
     return ix
+
+
+def remove_zdict(index_dir):
+    if os.path.isfile(os.path.join(index_dir, ZDICT_FILENAME)):
+        os.remove(os.path.join(index_dir, ZDICT_FILENAME))
+
+
+def new_codec(index_dir, ix):
+    # trained on the whole corpus before any body is compressed, and shared by every shard
+    with timer.stage('compress'):
+        with ix.reader() as reader:
+            zdict = train_zdict(fields['key_terms_content'] for fields in reader.all_stored_fields())
+        write_zdict(index_dir, zdict)
+    return BodyCodec(zdict)
+
+
+def get_book_groups(num_shards=None):
+    # one shard per book, or num_shards runs of consecutive books of about the same size
+    # in Books.indexed order either way, so shards in name order hold the documents in the same order one index would
+    if not num_shards:
+        return [[book] for book in Books.indexed]
+    sizes = [os.path.getsize("books/{}.txt".format(book['abbr'])) for book in Books.indexed]
+    groups = [[] for _ in range(num_shards)]
+    done = 0
+    for book, size in zip(Books.indexed, sizes):
+        # the run its middle falls in
+        groups[min(num_shards - 1, int((done + size / 2) * num_shards / sum(sizes)))].append(book)
+        done += size
+    return [group for group in groups if group]
+
+
+# these run in pool workers, so each hands back its own timings
+
+
+def build_shard(shard_dir, abbrs, compress):
+    timer.reset()
+    os.makedirs(shard_dir)
+    create_index(shard_dir, [book for book in Books.indexed if book['abbr'] in abbrs], compress)
+    return timer.report()
+
+
+def get_shard_key_terms(index_dir, shard_num):
+    # scored against every shard so they're the same key terms one index would give
+    timer.reset()
+    sharded = ShardedIndex(index_dir)
+    with sharded.reader() as collection, sharded.shards[shard_num].reader() as reader:
+        return get_doc_key_terms(reader, collection), timer.report()
+
+
+def add_shard_key_terms(shard_dir, doc_key_terms, zdict):
+    timer.reset()
+    add_key_terms(index.open_dir(shard_dir), doc_key_terms, BodyCodec(zdict) if zdict is not None else None)
+    return timer.report()
+
+
+def new_sharded_index(index_dir, num_shards=None, compress=False):
+    groups = get_book_groups(num_shards)
+    if num_shards:
+        names = ['{:02}'.format(i) for i in range(len(groups))]
+    else:
+        names = ['{:02}_{}'.format(i, group[0]['abbr'].lower()) for i, group in enumerate(groups)]
+    shard_dirs = [os.path.join(index_dir, SHARDS_DIR, name) for name in names]
+    shutil.rmtree(os.path.join(index_dir, SHARDS_DIR), ignore_errors=True)
+    remove_zdict(index_dir)
+
+    with multiprocessing.Pool() as pool:
+        reports = pool.starmap(build_shard, [(shard_dir, [book['abbr'] for book in group], compress) for shard_dir, group in zip(shard_dirs, groups)])
+        # in the order ShardedIndex numbers them
+        shard_dirs = get_shard_dirs(index_dir)
+        zdict = new_codec(index_dir, ShardedIndex(index_dir)).zdict if compress else None
+        # every shard has to exist before any key terms are scored, and none can be rewritten until all are
+        shard_key_terms = pool.starmap(get_shard_key_terms, [(index_dir, shard_num) for shard_num in range(len(shard_dirs))])
+        reports += [report for _, report in shard_key_terms]
+        reports += pool.starmap(add_shard_key_terms, [(shard_dir, doc_key_terms, zdict) for shard_dir, (doc_key_terms, _) in zip(shard_dirs, shard_key_terms)])
+    # stage seconds are summed over the workers
+    for report in reports:
+        timer.add_report(report)
+    return ShardedIndex(index_dir)
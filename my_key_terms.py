@@ -0,0 +1,63 @@
+from collections import defaultdict
+
+import numpy as np
+from whoosh.analysis import StemmingAnalyzer
+
+
+class KeyTerms:
+    # the same Bo1 scores Searcher.key_terms() gives one document at a time, for the whole corpus at once
+    # built from the postings, so no document text is re-analyzed
+    # collection is the reader the scores' statistics come from, e.g. every shard when reader is only one of them
+    def __init__(self, reader, fieldname, numterms=10, collection=None):
+        field = reader.schema[fieldname]
+        collection = collection or reader
+        doc_count = collection.doc_count_all()
+
+        self.terms = []
+        collection_weights = []
+        docnums, term_ids, weights = [], [], []
+        for term_id, (btext, terminfo) in enumerate(reader.iter_field(fieldname)):
+            self.terms.append(field.from_bytes(btext))
+            collection_weights.append(terminfo.weight() if collection is reader else collection.frequency(fieldname, btext))
+            m = reader.postings(fieldname, btext)
+            while m.is_active():
+                docnums.append(m.id())
+                term_ids.append(term_id)
+                weights.append(m.weight())
+                m.next()
+
+        docnums = np.array(docnums, dtype=np.int64)
+        term_ids = np.array(term_ids, dtype=np.int64)
+        f = np.array(collection_weights, dtype=np.float64)[term_ids] / doc_count
+        scores = np.array(weights, dtype=np.float64) * np.log2((1.0 + f) / f) + np.log2(1.0 + f)
+
+        # by document, then best score, then term text (term ids are in lexical order) just like key_terms()
+        order = np.lexsort((term_ids, -scores, docnums))
+        docnums, term_ids = docnums[order], term_ids[order]
+        rank = np.arange(len(docnums)) - np.searchsorted(docnums, docnums)
+        is_top = rank < numterms
+        docnums, term_ids = docnums[is_top], term_ids[is_top]
+
+        self.doc_terms = defaultdict(list)
+        for docnum, term_id in zip(docnums.tolist(), term_ids.tolist()):
+            self.doc_terms[docnum].append(term_id)
+
+        # each candidate term is stemmed once rather than once per document it's key to
+        stemmer = StemmingAnalyzer()
+        self.stems = {}
+        for term_id in np.unique(term_ids).tolist():
+            term = self.terms[term_id]
+            self.stems[term_id] = ' '.join(t.text for t in stemmer(term)) or term
+
+    def for_document(self, docnum, session_num=None):
+        result = []
+        seen_stems = set()
+        for term_id in self.doc_terms[docnum]:
+            term = self.terms[term_id]
+            # e.g. "636" or "636th" for session 636
+            if session_num and term.startswith(session_num):
+                continue
+            if self.stems[term_id] not in seen_stems:
+                result.append(term)
+                seen_stems.add(self.stems[term_id])
+        return result
@@ -0,0 +1,35 @@
+import json
+import re
+import urllib.parse
+
+TEMPLATE_PATH = 'templates/search-form.html'
+
+
+def load_queries(queries_path, template_path=TEMPLATE_PATH):
+    # the template's examples, after those in queries_path if it's given
+    queries = []
+    if queries_path:
+        with open(queries_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                query = entry.get('query') or entry.get('q') if isinstance(entry, dict) else None
+                if query:
+                    queries.append(query)
+        if not queries:
+            raise ValueError("no queries in {}, expected json lines with a 'query' or 'q' key".format(queries_path))
+    queries += get_template_examples(template_path)
+    return queries
+
+
+def get_template_examples(template_path=TEMPLATE_PATH):
+    with open(template_path, encoding='utf-8') as f:
+        return re.findall(r"""example\('(.+?)', """, f.read())
+
+
+def get_url(query):
+    # close enough to my_flask.urlize() to land on the same page without a redirect
+    query = query.strip().replace("'", ' ').replace('“', '"').replace('”', '"').replace('"', "'")
+    return '/q/{}/'.format(urllib.parse.quote_plus(query, "[]{}'()*:"))
@@ -0,0 +1,153 @@
+import multiprocessing
+import os
+import threading
+import time
+from heapq import nlargest
+
+from whoosh import index
+from whoosh.collectors import TopCollector
+from whoosh.reading import MultiReader
+from whoosh.searching import Searcher, Results
+
+from my_filters import get_reader_id
+
+# index/shards/<name>/ each hold an ordinary index of one book or group of books
+SHARDS_DIR = 'shards'
+# per serving process, so gunicorn workers times this should stay near the cpu count, 0 searches the shards in-process
+SEARCH_PROCESSES = int(os.environ.get('SHARD_SEARCH_PROCESSES', 2))
+
+
+def get_shard_dirs(index_dir):
+    shards_dir = os.path.join(index_dir, SHARDS_DIR)
+    return [os.path.join(shards_dir, name) for name in sorted(os.listdir(shards_dir))]
+
+
+def is_sharded(index_dir):
+    return os.path.isdir(os.path.join(index_dir, SHARDS_DIR))
+
+
+class ShardsReader(MultiReader):
+    # every shard's segments side by side, so docnums and BM25F statistics span the whole corpus just like one index
+    def __init__(self, shard_readers):
+        leaves = []
+        self.shard_bounds = []
+        for reader in shard_readers:
+            leaves.extend(leaf for leaf, _ in reader.leaf_readers())
+            self.shard_bounds.append(len(leaves))
+        MultiReader.__init__(self, leaves, generation=tuple(reader.generation() for reader in shard_readers))
+
+    def shard_leaves(self, shard_num):
+        # (start, end) into leaf_readers()
+        return self.shard_bounds[shard_num - 1] if shard_num else 0, self.shard_bounds[shard_num]
+
+
+class ShardedIndex:
+    # the parts of whoosh's Index the site uses, over every shard at once
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.shard_dirs = None
+        self.refresh()
+
+    def refresh(self):
+        # a rebuild replaces the shards, maybe with others, so reopen them once any open one is gone
+        shard_dirs = get_shard_dirs(self.index_dir)
+        if shard_dirs != self.shard_dirs or any(shard.latest_generation() < 0 for shard in self.shards):
+            self.shards = [index.open_dir(shard_dir) for shard_dir in shard_dirs]
+            self.shard_dirs = shard_dirs
+            self.schema = self.shards[0].schema
+        return self.shards
+
+    def reader(self):
+        return ShardsReader([shard.reader() for shard in self.refresh()])
+
+    def searcher(self, **kwargs):
+        return ScatterSearcher(self.reader(), fromindex=self, **kwargs)
+
+    def doc_count(self):
+        return sum(shard.doc_count() for shard in self.refresh())
+
+    def doc_count_all(self):
+        return sum(shard.doc_count_all() for shard in self.refresh())
+
+    def latest_generation(self):
+        return tuple(shard.latest_generation() for shard in self.refresh())
+
+    def last_modified(self):
+        return max(shard.last_modified() for shard in self.refresh())
+
+
+class ShardCollector(TopCollector):
+    # the top N of only one shard's segments, still scored by the searcher over all of them
+    def __init__(self, leaves, limit):
+        # pruning by quality would leave the total uncounted
+        TopCollector.__init__(self, limit=limit, usequality=False, replace=0)
+        self.leaves = leaves
+
+    def run(self):
+        start, end = self.leaves
+        try:
+            for subsearcher, offset in self.top_searcher.leaf_searchers()[start:end]:
+                self.set_subsearcher(subsearcher, offset)
+                self.collect_matches()
+        finally:
+            self.finish()
+
+
+class ScatterSearcher(Searcher):
+    # a plain top N search runs each shard in its own process and merges the results
+    # anything else (sorting, filters, more_like() etc.) searches here as usual
+    def search(self, q, limit=10, **kwargs):
+        shards = self.ixreader.shard_bounds
+        # a pool's own workers, e.g. cli.py --snapshots, can't start another pool
+        if kwargs or limit is None or len(shards) < 2 or not SEARCH_PROCESSES or multiprocessing.current_process().daemon:
+            return Searcher.search(self, q, limit=limit, **kwargs)
+
+        start_time = time.time()
+        weighting = type(self.weighting)
+        reader_id = get_reader_id(self.ixreader)
+        tasks = [(shard_num, q, weighting, limit, reader_id) for shard_num in range(len(shards))]
+        shard_results = get_pool(self._ix.index_dir).starmap(search_shard, tasks)
+
+        # the same order TopCollector gives: best score, then lowest docnum
+        items = nlargest(limit, (item for shard_items, _ in shard_results for item in shard_items))
+        results = Results(self, q, [(score, 0 - negated_docnum) for score, negated_docnum in items],
+                          runtime=time.time() - start_time)
+        results._total = sum(total for _, total in shard_results)
+        return results
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# per pool worker
+_worker_ix = None
+_worker_reader = None
+
+
+def get_pool(index_dir):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(SEARCH_PROCESSES, initializer=init_worker, initargs=(index_dir,))
+    return _pool
+
+
+def init_worker(index_dir):
+    global _worker_ix
+    _worker_ix = ShardedIndex(index_dir)
+
+
+def search_shard(shard_num, q, weighting, limit, reader_id):
+    # returns TopCollector's (score, negated docnum) heap items and the shard's total
+    # by segment, as a rebuild's shards have the same generations as the ones they replace
+    global _worker_reader
+    if _worker_reader is None or get_reader_id(_worker_reader) != reader_id:
+        if _worker_reader is not None:
+            _worker_reader.close()
+        _worker_reader = _worker_ix.reader()
+        if get_reader_id(_worker_reader) != reader_id:
+            raise RuntimeError("shards changed mid-search, expected segments {} got {}".format(reader_id, get_reader_id(_worker_reader)))
+
+    searcher = Searcher(_worker_reader, weighting=weighting, closereader=False)
+    collector = ShardCollector(_worker_reader.shard_leaves(shard_num), limit)
+    searcher.search_with_collector(q, collector)
+    return collector.items, collector.total
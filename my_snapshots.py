@@ -0,0 +1,90 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import shutil
+import urllib.parse
+from collections import Counter
+
+SNAPSHOT_DIR = 'snapshots'
+# None is the default relevance order
+SNAPSHOT_HIT_ORDERS = (None, 'asc', 'desc')
+SNAPSHOT_PAGES = 3
+# rendered as the live site, whose pages the template adds analytics to
+SNAPSHOT_HOST = 'search.sethtalks.com'
+next_page_re = re.compile(r'<a href="([^"]+)">Next ')
+
+
+def get_version_dir(version):
+    # version is the index's my_index.get_build_id() and my_flask.app_version the pages were rendered from
+    return os.path.join(SNAPSHOT_DIR, hashlib.sha1(str(version).encode('utf-8')).hexdigest()[:16])
+
+
+def get_snapshot_path(version, host, path):
+    # by host too, so only the host they were rendered for is served them
+    return os.path.join(get_version_dir(version), hashlib.sha1((host + path).encode('utf-8')).hexdigest() + '.html')
+
+
+def get_snapshot(version, host, path):
+    try:
+        with open(get_snapshot_path(version, host, path), encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def get_snapshot_urls(queries, top):
+    import my_flask
+    from flask import url_for
+    from my_queries import get_template_examples
+
+    # the template's examples are always included, then the most frequent of the rest
+    examples = get_template_examples()
+    queries = examples + [query for query, _ in Counter(queries).most_common(top) if query not in examples]
+    urls = ['/']
+    # the same urls as the site's own links and redirects, e.g. with book: names lowercase
+    with my_flask.app.test_request_context():
+        for query in queries:
+            for hit_order in SNAPSHOT_HIT_ORDERS:
+                urls.append(urllib.parse.unquote(url_for('search_form', q_query=my_flask.urlize(query), hit_order=hit_order)))
+    return urls
+
+
+_client = None
+
+
+def init_worker():
+    global _client
+    import my_flask
+    _client = my_flask.app.test_client()
+
+
+def render_url(url):
+    # the page and the ones after it, as (host, path, html) with the path redirects ended up at
+    result = []
+    for _ in range(SNAPSHOT_PAGES):
+        response = _client.get(url, base_url='http://' + SNAPSHOT_HOST, follow_redirects=True)
+        if response.status_code != 200:
+            break
+        page = response.get_data(as_text=True)
+        result.append((response.request.host, response.request.path, page))
+        m = next_page_re.search(page)
+        if not m:
+            break
+        url = m.group(1)
+    return result
+
+
+def write_snapshots(version, urls, processes=None):
+    # older versions can never be served again
+    shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+    os.makedirs(get_version_dir(version))
+
+    num_pages = 0
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        for pages in pool.imap_unordered(render_url, urls):
+            for host, path, page in pages:
+                with open(get_snapshot_path(version, host, path), 'w', encoding='utf-8') as f:
+                    f.write(page)
+                num_pages += 1
+    return num_pages
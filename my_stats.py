@@ -0,0 +1,183 @@
+import functools
+import pickle
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+from whoosh.codec.whoosh3 import W3Codec
+
+# in the order a rebuild goes through them
+REBUILD_STAGES = ('read', 'pre-process', 'split', 'analyze', 'write', 'commit', 'key terms', 'compress')
+# my_flask functions whose allocations are reported, nested stages count towards their callers too
+MEMORY_STAGES = ('search_whoosh', 'parse_query', 'get_html_results', 'get_html_hit', 'get_html_excerpts',
+                 'get_html_more_like', 'get_html_correction', 'render_template')
+
+
+def get_file_length(storage, filename):
+    return storage.file_length(filename) if storage.file_exists(filename) else 0
+
+
+def get_index_stats(ix):
+    fields = {fieldname: dict.fromkeys(('terms', 'postings_bytes', 'stored_bytes', 'column_bytes'), 0) for fieldname in ix.schema.names()}
+    with ix.reader() as reader:
+        for leaf, _ in reader.leaf_readers():
+            segment, storage = leaf.segment(), leaf.storage()
+            for fieldname in fields:
+                stats = fields[fieldname]
+                if not ix.schema[fieldname].indexed:
+                    continue
+                # a bytes prefix, as the default '' isn't a valid DATETIME
+                for _, terminfo in leaf.iter_field(fieldname, prefix=b''):
+                    stats['terms'] += 1
+                    if terminfo.is_inlined():
+                        stats['postings_bytes'] += len(terminfo.to_bytes())
+                    else:
+                        length = terminfo.extent()[1]
+                        # whoosh 2.7.4 reads the length back as a 1-tuple
+                        stats['postings_bytes'] += length[0] if isinstance(length, tuple) else length
+                stats['column_bytes'] += get_file_length(storage, W3Codec.column_filename(segment, fieldname))
+
+            # stored fields are one pickled dict per document, so attribute the pickled size of each value
+            for stored in leaf.all_stored_fields():
+                for fieldname, value in stored.items():
+                    fields[fieldname]['stored_bytes'] += len(pickle.dumps(value, -1))
+
+        return {
+            'generation': ix.latest_generation(),
+            'doc_count': reader.doc_count(),
+            'segments': len(reader.leaf_readers()),
+            'fields': fields,
+        }
+
+
+class StageTracer:
+    # tracemalloc's peak can only be reset by clearing its traces (reset_peak() needs python 3.9), so every stage
+    # clears them as it starts, carrying what was allocated until then, and hands its own peak back up to the caller
+    # memory allocated before a stage and freed during it isn't subtracted, which can only overstate a peak
+    def __init__(self):
+        self.stack = []
+        self.peaks = defaultdict(int)
+        self.calls = defaultdict(int)
+
+    def enter(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], self.stack[-1][0] + peak)
+            self.stack[-1][0] += current
+        tracemalloc.clear_traces()
+        # [allocated since the stage started, peak since the stage started]
+        self.stack.append([0, 0])
+
+    def leave(self):
+        current, peak = tracemalloc.get_traced_memory()
+        allocated, stage_peak = self.stack.pop()
+        stage_peak = max(stage_peak, allocated + peak)
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], self.stack[-1][0] + stage_peak)
+            self.stack[-1][0] += allocated + current
+        tracemalloc.clear_traces()
+        return stage_peak
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.enter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.peaks[name] = max(self.peaks[name], self.leave())
+                self.calls[name] += 1
+        return wrapper
+
+
+class RebuildTimer:
+    # seconds per rebuild stage, exclusive of any stage nested inside it, and per book throughput
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        self.stack = []
+        self.seconds = defaultdict(float)
+        self.books = {}
+
+    @contextmanager
+    def stage(self, name):
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] += elapsed - self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+
+    @contextmanager
+    def analysis(self, writer):
+        # field.index() is a generator consumed while writing, so run it to completion inside its own stage
+        # only for the life of the writer, its schema is pickled on commit
+        def timed(index):
+            def wrapper(value, **kwargs):
+                with self.stage('analyze'):
+                    return list(index(value, **kwargs))
+            return wrapper
+
+        fields = [field for _, field in writer.schema.items()]
+        for field in fields:
+            field.index = timed(field.index)
+        try:
+            yield
+        finally:
+            for field in fields:
+                del field.index
+
+    def book_done(self, abbr, docs, num_bytes, seconds):
+        self.books[abbr] = {'docs': docs, 'bytes': num_bytes, 'seconds': seconds,
+                            'docs_per_s': docs / seconds, 'mb_per_s': num_bytes / seconds / 2 ** 20}
+        if self.verbose:
+            print("{}\t{} docs\t{:.2f} s\t{:.0f} docs/s\t{:.2f} MB/s".format(abbr, docs, seconds, docs / seconds, num_bytes / seconds / 2 ** 20))
+
+    def add_report(self, report):
+        # from another process, e.g. a shard build
+        for name, seconds in report['stage_seconds'].items():
+            self.seconds[name] += seconds
+        self.books.update(report['books'])
+
+    def report(self):
+        return {'stage_seconds': dict(self.seconds), 'books': dict(self.books)}
+
+    def print_report(self):
+        total = sum(self.seconds.values())
+        for name in REBUILD_STAGES:
+            if name in self.seconds:
+                print("{:12}{:9.2f} s{:6.1f}%".format(name, self.seconds[name], self.seconds[name] / total * 100))
+
+
+def get_memory_stats(queries):
+    import my_flask
+    from my_queries import get_url
+
+    tracer = StageTracer()
+    for name in MEMORY_STAGES:
+        setattr(my_flask, name, tracer.wrap(name, getattr(my_flask, name)))
+    # a pre-rendered snapshot would be measured instead of the search
+    my_flask.get_snapshot = lambda version, host, path: None
+
+    client = my_flask.app.test_client()
+    query_peaks = {}
+    tracemalloc.start()
+    try:
+        for query in queries:
+            tracer.enter()
+            client.get(get_url(query))
+            query_peaks[query] = tracer.leave()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'stage_peak_bytes': dict(tracer.peaks),
+        'stage_calls': dict(tracer.calls),
+        'query_peak_bytes': query_peaks,
+    }
@@ -0,0 +1,86 @@
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+import numpy as np
+
+from my_index import get_build_id
+
+SUGGESTION_LIMIT = 10
+# a key term is a far better suggestion than its raw frequency would say
+KEY_TERM_BONUS = 50
+last_word_re = re.compile(r'^(?P<before>.*?)(?P<word>\w+)$', re.UNICODE)
+
+
+class Suggester:
+    # every suggestable word in one sorted array, a prefix is then a contiguous slice of it
+    def __init__(self, reader):
+        counts = Counter()
+        for btext, terminfo in reader.iter_field('exact'):
+            counts[btext.decode('utf-8')] += terminfo.doc_frequency()
+        # heading terms are stemmed, so only those that are also real words count
+        for btext, terminfo in reader.iter_field('heading'):
+            text = btext.decode('utf-8')
+            if text in counts:
+                counts[text] += terminfo.doc_frequency()
+        for fields in reader.all_stored_fields():
+            for key_term in fields.get('key_terms', ()):
+                counts[key_term.lower()] += KEY_TERM_BONUS
+
+        self.words = sorted(counts)
+        self.scores = np.array([counts[word] for word in self.words], dtype=np.int64)
+
+    def complete(self, prefix, limit=SUGGESTION_LIMIT):
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words, prefix + '\U0010ffff', start)
+        if start == end:
+            return []
+        scores = self.scores[start:end]
+        if end - start > limit:
+            # everything scoring at least the limit-th best, so ties at the cutoff are broken alphabetically too
+            cutoff = np.partition(scores, end - start - limit)[end - start - limit]
+            top = np.flatnonzero(scores >= cutoff)
+        else:
+            top = np.arange(end - start)
+        # best first, then alphabetical
+        top = sorted(top.tolist(), key=lambda i: (-scores[i], i))[:limit]
+        return [self.words[start + i] for i in top]
+
+    def suggest(self, query, limit=SUGGESTION_LIMIT):
+        # complete only the last plain word, everything before it is kept as typed
+        m = last_word_re.match(query)
+        if not m or m.group('before').endswith(':'):
+            return []
+        before = m.group('before')
+        return [before + word for word in self.complete(m.group('word').lower(), limit)]
+
+
+_suggester = None
+_suggester_build_id = None
+_pending_build_id = None
+_lock = threading.Lock()
+
+
+def build_suggester(ix, build_id):
+    global _suggester, _suggester_build_id
+    with ix.reader() as reader:
+        suggester = Suggester(reader)
+    with _lock:
+        _suggester, _suggester_build_id = suggester, build_id
+
+
+def get_suggester(ix):
+    # my_flask builds the first one as it opens the index, after a rebuild the old one answers until the new one is ready
+    global _pending_build_id
+    build_id = get_build_id(ix)
+    with _lock:
+        is_stale = build_id != _suggester_build_id and build_id != _pending_build_id
+        if is_stale:
+            _pending_build_id = build_id
+    if is_stale:
+        if _suggester is None:
+            build_suggester(ix, build_id)
+        else:
+            threading.Thread(target=build_suggester, args=(ix, build_id), daemon=True).start()
+    return _suggester
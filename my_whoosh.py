@@ -21,12 +21,15 @@
 
 # this file is not licensed under https://github.com/CodeOptimist/whoosh-galpin/blob/master/LICENSE
 # it's MIT licensed (given above) for folding into Whoosh proper
-from whoosh.highlight import Fragmenter, Fragment, BasicFragmentScorer, HtmlFormatter
+from whoosh.analysis import Token
+from whoosh.highlight import Fragmenter, Fragment, BasicFragmentScorer, HtmlFormatter, Highlighter, top_fragments
 from whoosh.scoring import BM25F
-from datetime import datetime, timedelta
+from array import array
 from bs4 import BeautifulSoup
 import re
 
+from my_dates import NO_DATE_KEY, DATE_KEY_SPAN
+
 
 def get_sentence_fragments(paragraph):
     paragraph_soup = BeautifulSoup(paragraph, 'lxml')
@@ -81,22 +84,26 @@ def get_deepest_tag(needle_soup, haystack_soup):
 
 
 class ParagraphFragmenter(Fragmenter):
-    def fragment_matches(self, text, matched_tokens):
-        pass
+    charlimit = None
+
+    def must_retokenize(self):
+        return False
 
     def fragment_tokens(self, text, tokens):
+        return self.fragment_matches(text, (t for t in tokens if t.matched))
+
+    def fragment_matches(self, text, matched_tokens):
         paragraph_tokens = []
         last = (None, None)
 
-        for t in tokens:
-            if t.matched:
-                cur = self.get_paragraph_pos(text, t)
+        for t in matched_tokens:
+            cur = self.get_paragraph_pos(text, t)
 
-                if cur != last and paragraph_tokens:
-                    yield Fragment(text, paragraph_tokens, last[0], last[1])
-                    paragraph_tokens = []
-                paragraph_tokens.append(t.copy())
-                last = cur
+            if cur != last and paragraph_tokens:
+                yield Fragment(text, paragraph_tokens, last[0], last[1])
+                paragraph_tokens = []
+            paragraph_tokens.append(t.copy())
+            last = cur
 
         if paragraph_tokens:
             yield Fragment(text, paragraph_tokens, last[0], last[1])
@@ -114,6 +121,36 @@ class ParagraphFragmenter(Fragmenter):
         return paragraph_start, paragraph_end
 
 
+class PinpointHighlighter(Highlighter):
+    # reads match offsets from the postings of fields indexed with chars=True rather than re-analyzing the stored text
+    # unlike Highlighter's own pinpoint mode it highlights every query term in the document, not just those that matched,
+    # so the output is the same as retokenizing
+    def highlight_hit(self, hitobj, fieldname, text=None, top=3, minscore=1):
+        results = hitobj.results
+        field = results.searcher.schema[fieldname]
+        if self.always_retokenize or self.fragmenter.must_retokenize() or not field.supports('characters'):
+            return super().highlight_hit(hitobj, fieldname, text, top, minscore)
+
+        if text is None:
+            text = hitobj[fieldname]
+
+        reader = results.searcher.reader()
+        tokens = []
+        for _, btext in results.query_terms(expand=True, fieldname=fieldname):
+            m = reader.postings(fieldname, btext)
+            m.skip_to(hitobj.docnum)
+            if not m.is_active() or m.id() != hitobj.docnum:
+                continue
+            word = field.from_bytes(btext)
+            for pos, startchar, endchar in m.value_as('characters'):
+                tokens.append(Token(text=word, pos=pos, startchar=startchar, endchar=endchar, matched=True))
+        tokens.sort(key=lambda t: t.startchar)
+
+        fragments = self.fragmenter.fragment_matches(text, tokens)
+        fragments = top_fragments(fragments, top, self.scorer, self.order, minscore=minscore)
+        return self.formatter.format(fragments)
+
+
 class ConsistentFragmentScorer(BasicFragmentScorer):
     def __call__(self, f):
         score = super().__call__(f)
@@ -126,19 +163,25 @@ class ConsistentFragmentScorer(BasicFragmentScorer):
 
 class DateBM25F(BM25F):
     use_final = True
+    _date_keys = (None, None)
+
+    def date_keys(self, searcher):
+        # the column is read once per reader rather than unpickling stored fields for every hit
+        reader, date_keys = self._date_keys
+        if reader is not searcher.reader():
+            reader = searcher.reader()
+            date_keys = array('q', reader.column_reader('date_key'))
+            self._date_keys = (reader, date_keys)
+        return date_keys
 
     def final(self, searcher, docnum, score):
-        fields = searcher.stored_fields(docnum)
+        date_key = self.date_keys(searcher)[docnum]
         score = 1 - 1 / score
-        if 'date' in fields:
-            chapter_m = re.search(r'chapter\W*(\d+)', fields['heading'], re.IGNORECASE)
-            chapter = int(chapter_m.group(1)) if chapter_m else 0
-            date = fields['date'] + timedelta(seconds=chapter)
-            assert isinstance(date, datetime)
+        if date_key != NO_DATE_KEY:
             if isinstance(self, DescDateBM25F):
-                date_score = (date - datetime(1800, 1, 1)).total_seconds()
+                date_score = date_key
             elif isinstance(self, AscDateBM25F):
-                date_score = (datetime(2200, 1, 1) - date).total_seconds()
+                date_score = DATE_KEY_SPAN - date_key
             else:
                 raise NotImplementedError
             score += date_score + 1.0